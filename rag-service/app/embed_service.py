@@ -0,0 +1,48 @@
+"""
+Embedding Service - Ray Serve deployment for the shared embedding model
+Hosts a single embedding model for all RAG service workers (EMBED_BACKEND=ray)
+
+Start a Ray cluster, then deploy with:
+    python -m app.embed_service
+"""
+import os
+import time
+import logging
+from typing import List
+import numpy as np
+import ray
+from ray import serve
+
+from .model_clients import load_local_embed_model, RAY_ADDRESS, RAY_EMBED_APP
+
+logger = logging.getLogger(__name__)
+
+@serve.deployment(num_replicas=1, max_ongoing_requests=64)
+class EmbedService:
+    """One embedding model replica shared by every FastAPI worker"""
+
+    def __init__(self):
+        self.model = load_local_embed_model(os.getenv("RAY_EMBED_LOCAL_BACKEND", "onnx"))
+
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    @serve.batch(max_batch_size=32, batch_wait_timeout_s=0.005)
+    async def __call__(self, texts: List[str]) -> List[np.ndarray]:
+        vectors = self.model.encode(
+            texts,
+            batch_size=len(texts),
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        return list(vectors)
+
+embed_app = EmbedService.bind()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ray.init(address=RAY_ADDRESS)
+    serve.run(embed_app, name=RAY_EMBED_APP, route_prefix=None)
+    logger.info(f"Embedding service deployed as Ray Serve app '{RAY_EMBED_APP}'")
+    while True:
+        time.sleep(3600)
@@ -4,14 +4,17 @@ Provides REST API endpoints for RAG-based question answering
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, List
+import asyncio
+import json
 import logging
 import os
 from dotenv import load_dotenv
 
-from .rag_pipeline import answer_query, retrieve_top_k
-from .model_clients import verify_ollama_available, get_embed_model
+from .rag_pipeline import answer_query, stream_answer_query, retrieve_top_k, invalidate_query_cache, QDRANT_REQUIRED
+from .model_clients import verify_ollama_available, get_embed_model, get_prompt_tokenizer, close_ollama_client
 
 # Load environment variables
 load_dotenv()
@@ -30,6 +33,9 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Set once the embedding model has been loaded (and warmed up) in the background
+_READY = asyncio.Event()
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -64,9 +70,19 @@ class HealthResponse(BaseModel):
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint (503 until the embedding model is loaded)"""
+    if not _READY.is_set():
+        return JSONResponse(
+            status_code=503,
+            content=HealthResponse(
+                status="loading",
+                ollama_available=False,
+                qdrant_available=False,
+                embedding_model=os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+            ).model_dump()
+        )
     try:
-        ollama_ok = verify_ollama_available()
+        ollama_ok = await verify_ollama_available()
         qdrant_ok = True  # Will be checked in retrieve_top_k if needed
         embed_model = get_embed_model()
         embed_dim = embed_model.get_sentence_embedding_dimension()
@@ -106,7 +122,7 @@ async def chat_endpoint(request: ChatRequest):
             raise HTTPException(status_code=400, detail="Query cannot be empty")
         
         # Execute RAG pipeline
-        result = answer_query(
+        result = await answer_query(
             query=request.query,
             k=request.k or 6,
             verify_numbers=request.verify_numbers,
@@ -131,6 +147,33 @@ async def chat_endpoint(request: ChatRequest):
             error=str(e)
         )
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Streaming RAG endpoint - sends answer tokens as Server-Sent Events
+    
+    Each event is a JSON object with a "type" of "sources", "token", "done" or "error"
+    """
+    if not request.query or not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    
+    logger.info(f"Processing streaming RAG query: {request.query[:100]}...")
+    
+    async def event_stream():
+        async for event in stream_answer_query(
+            query=request.query,
+            k=request.k or 6,
+            verify_numbers=request.verify_numbers,
+            filter_dict=request.filter
+        ):
+            yield f"data: {json.dumps(event, default=str)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/search")
 async def search_endpoint(query: str, k: int = 6):
     """
@@ -139,7 +182,7 @@ async def search_endpoint(query: str, k: int = 6):
     Useful for debugging and understanding what documents are retrieved
     """
     try:
-        hits = retrieve_top_k(query, k=k)
+        hits = await retrieve_top_k(query, k=k)
         return {
             "query": query,
             "results": hits,
@@ -149,6 +192,32 @@ async def search_endpoint(query: str, k: int = 6):
         logger.error(f"Error in search: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/cache/invalidate")
+async def invalidate_cache_endpoint():
+    """
+    Invalidate cached retrieval results
+
+    Called by the ingestion script after new documents are indexed
+    """
+    version = invalidate_query_cache()
+    return {"status": "invalidated", "cache_version": version}
+
+def _load_and_warm_embed_model():
+    """Load (and warm up) the embedding model and the prompt tokenizer"""
+    embed_model = get_embed_model()
+    get_prompt_tokenizer()
+    return embed_model
+
+def _on_embed_model_loaded(future: asyncio.Future):
+    """Mark the service ready once the background model load finishes"""
+    try:
+        embed_model = future.result()
+        logger.info(f"✅ Embedding model loaded: {embed_model.get_sentence_embedding_dimension()} dimensions")
+    except Exception as e:
+        logger.error(f"❌ Failed to load embedding model: {e}")
+        logger.warning("RAG service will continue but embedding operations will fail")
+    _READY.set()
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup"""
@@ -160,35 +229,51 @@ async def startup_event():
                 f"QDRANT_URL={os.getenv('QDRANT_URL', 'http://localhost:6333')}, "
                 f"COLLECTION={os.getenv('QDRANT_COLLECTION', 'audit_documents')}")
     
-    # Pre-load embedding model
-    try:
-        embed_model = get_embed_model()
-        logger.info(f"✅ Embedding model loaded: {embed_model.get_sentence_embedding_dimension()} dimensions")
-    except Exception as e:
-        logger.error(f"❌ Failed to load embedding model: {e}")
-        logger.warning("RAG service will continue but embedding operations will fail")
+    # Load embedding model in the background so the server accepts connections immediately
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, _load_and_warm_embed_model).add_done_callback(_on_embed_model_loaded)
     
     # Check Qdrant
     try:
         from .rag_pipeline import qclient
         if qclient is not None:
-            collections = qclient.get_collections()
+            collections = await qclient.get_collections()
             logger.info(f"✅ Qdrant connected. Collections: {len(collections.collections)}")
         else:
             logger.warning("⚠️  Qdrant client not initialized - vector search will not work")
     except Exception as e:
+        if QDRANT_REQUIRED:
+            raise RuntimeError(f"Qdrant is required (QDRANT_REQUIRED=true) but unreachable: {e}") from e
         logger.warning(f"⚠️  Qdrant check failed: {e}. Vector search may not work until Qdrant is available.")
     
     # Check Ollama
-    if verify_ollama_available():
+    if await verify_ollama_available():
         logger.info("✅ Ollama is available")
     else:
         logger.warning("⚠️  Ollama is not available - LLM generation will fail. Install and start Ollama to enable LLM responses.")
     
     logger.info("🚀 RAG Service started successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release pooled connections on shutdown"""
+    await close_ollama_client()
+    try:
+        from .rag_pipeline import qclient
+        if qclient is not None:
+            await qclient.close()
+    except Exception as e:
+        logger.warning(f"Error closing Qdrant client: {e}")
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("RAG_SERVICE_PORT", "8001"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Caches are per process and /api/cache/invalidate reaches only one worker,
+    # so more than one worker means stale results until entries expire
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("WEB_WORKERS", "1"))
+    )
 
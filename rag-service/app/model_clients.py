@@ -2,10 +2,17 @@
 Model Clients - Embedding and LLM client wrappers
 Handles SentenceTransformers for embeddings and Ollama for LLM inference
 """
+import asyncio
+import functools
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from typing import Optional
+from typing import Optional, List, Union, AsyncIterator
 import httpx
 import logging
 
@@ -13,26 +20,388 @@ logger = logging.getLogger(__name__)
 
 # Embedding model (singleton)
 _EMBED = None
+_EMBED_LOCK = threading.Lock()
 EMBED_NAME = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")  # Faster, smaller model for PoC
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx")  # "onnx" (INT8 ONNX Runtime), "torch" or "ray" (shared Ray Serve model)
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(os.path.dirname(__file__), "..", ".onnx_models"))
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+class OnnxEmbeddingModel:
+    """
+    INT8-quantized ONNX Runtime drop-in for SentenceTransformer
+
+    Exports the transformer to ONNX once, applies dynamic INT8 quantization and
+    caches the result under ONNX_MODEL_DIR. Encoding tokenizes with the HF
+    tokenizer, runs the ONNX session and mean-pools the token embeddings, so
+    vectors match the SentenceTransformer pooling of the same model.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = ONNX_MODEL_DIR, num_threads: int = ONNX_INTRA_OP_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        hub_name = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        model_dir = os.path.join(cache_dir, hub_name.replace("/", "__") + "-int8")
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            # Multiple uvicorn workers may start at once; only one exports, the rest wait
+            import fcntl
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(model_dir + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(model_path):
+                        self._export_quantized(hub_name, model_dir)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self._dimension = self.session.get_outputs()[0].shape[-1]
+
+    @staticmethod
+    def _export_quantized(hub_name: str, model_dir: str):
+        """Export the model to ONNX and quantize its weights to INT8"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        logger.info(f"Exporting {hub_name} to ONNX with INT8 quantization (one-time)...")
+        onnx_model = ORTModelForFeatureExtraction.from_pretrained(hub_name, export=True)
+        quantizer = ORTQuantizer.from_pretrained(onnx_model)
+        quantizer.quantize(
+            save_dir=model_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+        AutoTokenizer.from_pretrained(hub_name).save_pretrained(model_dir)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dimension
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        **kwargs
+    ) -> np.ndarray:
+        """Encode sentences into mean-pooled embeddings (SentenceTransformer-compatible)"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=256,
+                return_tensors="np"
+            )
+            feeds = {name: tokens[name].astype(np.int64) for name in self._input_names if name in tokens}
+            if "token_type_ids" in self._input_names and "token_type_ids" not in feeds:
+                feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            batches.append((token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        embeddings = np.vstack(batches) if batches else np.zeros((0, self._dimension), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        embeddings = embeddings.astype(np.float32)
+        return embeddings[0] if single else embeddings
+
+# Ray Serve configuration for EMBED_BACKEND=ray (see embed_service.py)
+RAY_ADDRESS = os.getenv("RAY_ADDRESS", "auto")
+RAY_EMBED_APP = os.getenv("RAY_EMBED_APP", "embed")
+
+class RayEmbeddingClient:
+    """
+    Client for the shared Ray Serve embedding deployment
+
+    Every uvicorn worker sends texts to the single model replica started by
+    embed_service.py instead of loading its own copy; the deployment batches
+    requests across workers. Returned embeddings are always L2-normalized.
+    """
+
+    def __init__(self, app_name: str = RAY_EMBED_APP):
+        import ray
+        from ray import serve
+
+        if not ray.is_initialized():
+            ray.init(address=RAY_ADDRESS, ignore_reinit_error=True)
+        self._handle = serve.get_app_handle(app_name)
+        self._dimension = self._handle.dimension.remote().result()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dimension
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = True,
+        **kwargs
+    ) -> np.ndarray:
+        """Encode sentences on the shared deployment (SentenceTransformer-compatible)"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        responses = [self._handle.remote(text) for text in texts]
+        embeddings = np.asarray([r.result() for r in responses], dtype=np.float32).reshape(len(texts), self._dimension)
+        return embeddings[0] if single else embeddings
+
+def load_local_embed_model(backend: str = EMBED_BACKEND):
+    """Load an in-process embedding model, falling back to PyTorch"""
+    if backend == "onnx":
+        try:
+            return OnnxEmbeddingModel(EMBED_NAME)
+        except ImportError as e:
+            logger.warning(f"ONNX Runtime backend unavailable ({e}); using SentenceTransformer")
+        except Exception as e:
+            logger.warning(f"Failed to load ONNX embedding model ({e}); using SentenceTransformer")
+    return SentenceTransformer(EMBED_NAME)
+
+def _load_embed_model():
+    """Load the configured embedding backend"""
+    if EMBED_BACKEND == "ray":
+        return RayEmbeddingClient(RAY_EMBED_APP)
+    return load_local_embed_model(EMBED_BACKEND)
 
 def get_embed_model():
-    """Get or initialize the embedding model singleton"""
+    """Get or initialize the embedding model singleton, warmed up with a dummy encode"""
     global _EMBED
     if _EMBED is None:
-        try:
-            logger.info(f"Loading embedding model: {EMBED_NAME}")
-            _EMBED = SentenceTransformer(EMBED_NAME)
-            logger.info(f"Embedding model loaded. Dimension: {_EMBED.get_sentence_embedding_dimension()}")
-        except Exception as e:
-            logger.error(f"Failed to load embedding model: {e}")
-            raise
+        # Requests can race the background startup load; only one thread loads the model
+        with _EMBED_LOCK:
+            if _EMBED is None:
+                try:
+                    logger.info(f"Loading embedding model: {EMBED_NAME} (backend: {EMBED_BACKEND})")
+                    embed_model = _load_embed_model()
+                    # Pay one-off kernel setup/autotune cost here rather than on the first query
+                    embed_model.encode(["warmup"], convert_to_numpy=True)
+                    _EMBED = embed_model
+                    logger.info(f"Embedding model loaded. Dimension: {_EMBED.get_sentence_embedding_dimension()}")
+                except Exception as e:
+                    logger.error(f"Failed to load embedding model: {e}")
+                    raise
     return _EMBED
 
+# Dynamic batching configuration for query embeddings
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_LATENCY_MS = float(os.getenv("EMBED_BATCH_LATENCY_MS", "5"))
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent single-query encode calls into one batched encode
+
+    Callers block on a Future while a background worker collects requests
+    arriving within max_latency_ms (up to max_batch_size) and encodes them
+    with a single model.encode call.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_latency_ms: float = 5.0):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def encode(self, text: str) -> np.ndarray:
+        """Encode a single text, sharing the model call with concurrent requests"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            texts = [text for text, _ in batch]
+            try:
+                vectors = get_embed_model().encode(
+                    texts,
+                    batch_size=len(texts),
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+            except Exception as e:
+                logger.error(f"Batched embedding of {len(texts)} queries failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            vectors = np.asarray(vectors, dtype=np.float32)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+_BATCHER = EmbeddingBatcher(max_batch_size=EMBED_BATCH_SIZE, max_latency_ms=EMBED_BATCH_LATENCY_MS)
+
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "4096"))
+
+@functools.lru_cache(maxsize=QUERY_EMBED_CACHE_SIZE)
+def _encode_query_cached(text: str) -> np.ndarray:
+    vector = _BATCHER.encode(text)
+    vector.setflags(write=False)  # shared between callers via the cache
+    return vector
+
+def encode_query(text: str) -> np.ndarray:
+    """Encode a query into a normalized embedding via the dynamic batcher (exact repeats are cached)"""
+    return _encode_query_cached(text.strip())
+
+async def encode_query_async(text: str) -> np.ndarray:
+    """Encode a query in the default executor so the event loop stays free"""
+    return await asyncio.get_running_loop().run_in_executor(None, encode_query, text)
+
+def encode_queries(texts: List[str]) -> np.ndarray:
+    """Encode a known batch of queries with a single model call, bypassing the dynamic batcher"""
+    vectors = get_embed_model().encode(
+        [text.strip() for text in texts],
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    )
+    return np.asarray(vectors, dtype=np.float32)
+
+async def encode_queries_async(texts: List[str]) -> np.ndarray:
+    """Encode a batch of queries in the default executor so the event loop stays free"""
+    return await asyncio.get_running_loop().run_in_executor(None, encode_queries, texts)
+
+# Tokenizer used to budget prompt context (should match OLLAMA_MODEL's family; llama uses sentencepiece)
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "hf-internal-testing/llama-tokenizer")
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+_TOKENIZER_UNAVAILABLE = False
+
+def get_prompt_tokenizer():
+    """Get or initialize the prompt tokenizer singleton (None if it cannot be loaded)"""
+    global _TOKENIZER, _TOKENIZER_UNAVAILABLE
+    if _TOKENIZER is None and not _TOKENIZER_UNAVAILABLE:
+        with _TOKENIZER_LOCK:
+            if _TOKENIZER is None and not _TOKENIZER_UNAVAILABLE:
+                try:
+                    from transformers import AutoTokenizer
+                    logger.info(f"Loading prompt tokenizer: {PROMPT_TOKENIZER}")
+                    _TOKENIZER = AutoTokenizer.from_pretrained(PROMPT_TOKENIZER, use_fast=True)
+                except Exception as e:
+                    logger.warning(f"Prompt tokenizer unavailable ({e}); estimating tokens from characters")
+                    _TOKENIZER_UNAVAILABLE = True
+    return _TOKENIZER
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Count LLM tokens in text (cached, since the same hits are retrieved repeatedly)"""
+    tokenizer = get_prompt_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
 # Ollama client configuration
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama2:7b")
+# How long Ollama keeps the model (and its cached system-prompt KV) loaded between requests
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+
+def _duration_seconds(value: str) -> float:
+    """Parse an Ollama keep_alive duration ("1h", "30m", "300s", "300", "-1") into seconds"""
+    units = {"h": 3600, "m": 60, "s": 1}
+    value = value.strip()
+    try:
+        if value and value[-1] in units:
+            seconds = float(value[:-1]) * units[value[-1]]
+        else:
+            seconds = float(value)
+    except ValueError:
+        return 300.0  # Ollama's default keep_alive
+    return float("inf") if seconds < 0 else seconds
 
-def call_local_llama(prompt: str, max_tokens: int = 512, temperature: float = 0.0) -> str:
+OLLAMA_KEEP_ALIVE_SECONDS = _duration_seconds(OLLAMA_KEEP_ALIVE)
+# Context window requested from Ollama (its default is 2048); must hold the system
+# prompt, PROMPT_MAX_CONTEXT_TOKENS of context, the question and num_predict
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+
+DEFAULT_SYSTEM_PROMPT = "You are an expert AI Audit Assistant. Provide accurate, helpful responses based ONLY on the audit data provided in the context. If the answer is not in the context, say 'I don't know'."
+
+# Shared keep-alive connection pool to Ollama (avoids a TCP handshake per request)
+_ASYNC_OLLAMA = httpx.AsyncClient(
+    base_url=OLLAMA_URL,
+    timeout=120.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    http2=False
+)
+
+async def close_ollama_client():
+    """Close the shared Ollama connection pool"""
+    await _ASYNC_OLLAMA.aclose()
+
+def _chat_payload(
+    prompt: str,
+    max_tokens: int,
+    temperature: float,
+    stream: bool,
+    system: Optional[str] = None
+) -> dict:
+    """
+    Build the Ollama /api/chat request body
+
+    The system message is sent first and unchanged across requests, so Ollama
+    reuses its cached KV prefix; num_keep keeps those tokens when the context
+    window shifts.
+    """
+    system = system or DEFAULT_SYSTEM_PROMPT
+    return {
+        "model": OLLAMA_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": system
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "temperature": temperature,
+            "num_predict": max_tokens,
+            "num_ctx": OLLAMA_NUM_CTX,
+            "num_keep": count_tokens(system)
+        }
+    }
+
+class LLMError(RuntimeError):
+    """Raised when the LLM call fails or returns no usable completion"""
+
+async def call_local_llama(
+    prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.0,
+    system: Optional[str] = None
+) -> str:
     """
     Call local Ollama LLM via HTTP API
     
@@ -40,75 +409,114 @@ def call_local_llama(prompt: str, max_tokens: int = 512, temperature: float = 0.
         prompt: The prompt to send to LLM
         max_tokens: Maximum tokens to generate
         temperature: Sampling temperature (0.0 for deterministic)
+        system: System prompt (defaults to DEFAULT_SYSTEM_PROMPT)
     
     Returns:
         Generated text response
+    
+    Raises:
+        LLMError: If the request fails or the response has no completion text
     """
     try:
-        with httpx.Client(timeout=120.0) as client:
-            response = client.post(
-                f"{OLLAMA_URL}/api/chat",
-                json={
-                    "model": OLLAMA_MODEL,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "You are an expert AI Audit Assistant. Provide accurate, helpful responses based ONLY on the audit data provided in the context. If the answer is not in the context, say 'I don't know'."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "stream": False,
-                    "options": {
-                        "temperature": temperature,
-                        "num_predict": max_tokens
-                    }
-                }
-            )
-            response.raise_for_status()
-            data = response.json()
-            
-            # Extract response text - handle multiple response formats
-            response_text = None
-            
-            # Try different response formats
-            if data.get("message") and isinstance(data["message"], dict):
-                response_text = data["message"].get("content")
-            elif data.get("message") and isinstance(data["message"], str):
-                response_text = data["message"]
-            elif data.get("response"):
-                response_text = data["response"]
-            elif isinstance(data, str):
-                response_text = data
-            
-            if response_text and isinstance(response_text, str) and response_text.strip():
-                return response_text.strip()
-            else:
-                logger.warning(f"Unexpected Ollama response format: {data}")
-                return "I apologize, but I couldn't generate a response. Please try again."
-                
-    except httpx.TimeoutException:
+        response = await _ASYNC_OLLAMA.post(
+            "/api/chat",
+            json=_chat_payload(prompt, max_tokens, temperature, stream=False, system=system)
+        )
+        response.raise_for_status()
+        data = response.json()
+        
+        # Extract response text - handle multiple response formats
+        response_text = None
+        
+        # Try different response formats
+        if data.get("message") and isinstance(data["message"], dict):
+            response_text = data["message"].get("content")
+        elif data.get("message") and isinstance(data["message"], str):
+            response_text = data["message"]
+        elif data.get("response"):
+            response_text = data["response"]
+        elif isinstance(data, str):
+            response_text = data
+        
+    except httpx.TimeoutException as e:
         logger.error(f"Ollama request timed out after 120s")
-        return "Request timed out. Please try again."
+        raise LLMError("Request timed out") from e
     except httpx.RequestError as e:
         logger.error(f"Ollama request failed: {e}")
-        return f"I encountered an error connecting to the LLM service: {str(e)}"
+        raise LLMError(f"Could not connect to the LLM service: {e}") from e
     except Exception as e:
         logger.error(f"Unexpected error calling Ollama: {e}")
-        return f"An unexpected error occurred: {str(e)}"
+        raise LLMError(f"Unexpected LLM error: {e}") from e
+    
+    if response_text and isinstance(response_text, str) and response_text.strip():
+        return response_text.strip()
+    logger.warning(f"Unexpected Ollama response format: {data}")
+    raise LLMError("LLM returned an empty or unrecognized response")
+
+async def prefill_local_llama(system: Optional[str] = None) -> None:
+    """
+    Warm Ollama's KV cache with the system prompt while other work runs
+    
+    Sends the static system message with a single-token generation budget so
+    the following real request only has to prefill the variable user message.
+    Failures are ignored; this is purely an optimization.
+    """
+    try:
+        response = await _ASYNC_OLLAMA.post(
+            "/api/chat",
+            json=_chat_payload("", max_tokens=1, temperature=0.0, stream=False, system=system)
+        )
+        response.raise_for_status()
+    except Exception as e:
+        logger.debug(f"Ollama prefix prefill skipped: {e}")
+
+async def call_local_llama_stream(
+    prompt: str,
+    max_tokens: int = 512,
+    temperature: float = 0.0,
+    system: Optional[str] = None
+) -> AsyncIterator[str]:
+    """
+    Stream tokens from local Ollama LLM as they are generated
+    
+    Args:
+        prompt: The prompt to send to LLM
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0 for deterministic)
+        system: System prompt (defaults to DEFAULT_SYSTEM_PROMPT)
+    
+    Yields:
+        Generated text chunks; raises httpx errors to the caller, and LLMError
+        if Ollama reports an error or the stream ends before completion
+    """
+    async with _ASYNC_OLLAMA.stream(
+        "POST",
+        "/api/chat",
+        json=_chat_payload(prompt, max_tokens, temperature, stream=True, system=system)
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise LLMError(f"LLM stream failed: {chunk['error']}")
+            content = (chunk.get("message") or {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                return
+    raise LLMError("LLM stream ended before completion")
 
-def verify_ollama_available() -> bool:
+async def verify_ollama_available() -> bool:
     """Check if Ollama is available and model exists"""
     try:
-        with httpx.Client(timeout=5.0) as client:
-            response = client.get(f"{OLLAMA_URL}/api/tags")
-            if response.status_code == 200:
-                models = response.json().get("models", [])
-                model_names = [m.get("name", "") for m in models]
-                logger.info(f"Ollama available. Models: {', '.join(model_names)}")
-                return True
+        response = await _ASYNC_OLLAMA.get("/api/tags", timeout=5.0)
+        if response.status_code == 200:
+            models = response.json().get("models", [])
+            model_names = [m.get("name", "") for m in models]
+            logger.info(f"Ollama available. Models: {', '.join(model_names)}")
+            return True
     except Exception as e:
         logger.warning(f"Ollama not available: {e}")
     return False
@@ -2,13 +2,24 @@
 RAG Pipeline - Retrieval-Augmented Generation implementation
 Handles document retrieval from Qdrant, prompt building, and LLM generation
 """
+import asyncio
+import functools
 import os
 import re
-from typing import List, Dict, Optional
-from qdrant_client import QdrantClient
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Hashable, AsyncIterator
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
 import numpy as np
-from .model_clients import get_embed_model, call_local_llama
+import httpx
+import grpc
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+from .model_clients import (
+    encode_query_async, encode_queries_async, call_local_llama, call_local_llama_stream, prefill_local_llama, count_tokens,
+    OLLAMA_KEEP_ALIVE_SECONDS
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,23 +27,349 @@ logger = logging.getLogger(__name__)
 # Qdrant configuration
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "audit_documents")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", "32"))
+QDRANT_HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", "64"))
+QDRANT_PREFETCH_FACTOR = int(os.getenv("QDRANT_PREFETCH_FACTOR", "10"))
+RETRIEVAL_BATCH_SIZE = int(os.getenv("RETRIEVAL_BATCH_SIZE", "16"))
+RETRIEVAL_BATCH_WAIT_MS = float(os.getenv("RETRIEVAL_BATCH_WAIT_MS", "5"))
+# Fail at boot instead of degrading to empty retrievals when Qdrant is unusable
+QDRANT_REQUIRED = os.getenv("QDRANT_REQUIRED", "false").lower() == "true"
 
-# Initialize Qdrant client
+# Errors a Qdrant search can raise over REST or gRPC; anything else is a bug and propagates
+_QDRANT_ERRORS = (ResponseHandlingException, UnexpectedResponse, grpc.RpcError, httpx.HTTPError, asyncio.TimeoutError)
+
+def _create_qdrant_client() -> AsyncQdrantClient:
+    """
+    Create the Qdrant client, using gRPC (binary protobuf vectors) unless disabled
+
+    gRPC multiplexes concurrent searches over one HTTP/2 channel; the REST
+    fallback keeps a pool of keep-alive connections (qdrant-client disables
+    keep-alive for localhost by default).
+    """
+    return AsyncQdrantClient(
+        url=QDRANT_URL,
+        prefer_grpc=QDRANT_PREFER_GRPC,
+        grpc_port=QDRANT_GRPC_PORT,
+        grpc_options={"grpc.keepalive_time_ms": 30000},
+        limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_POOL_SIZE),
+        timeout=10.0
+    )
+
+# Initialize Qdrant client (connectivity is checked in the service startup hook)
 qclient = None
 try:
-    qclient = QdrantClient(url=QDRANT_URL, timeout=10.0)
-    # Test connection by checking collections
-    try:
-        collections = qclient.get_collections()
-        logger.info(f"Connected to Qdrant at {QDRANT_URL}. Collections: {len(collections.collections)}")
-    except Exception as test_error:
-        logger.warning(f"Qdrant connection test failed: {test_error}. Will attempt connection on first query.")
+    qclient = _create_qdrant_client()
 except Exception as e:
+    if QDRANT_REQUIRED:
+        raise RuntimeError(f"Qdrant is required (QDRANT_REQUIRED=true) but the client could not be created: {e}") from e
     logger.error(f"Failed to initialize Qdrant client: {e}")
     logger.warning("Qdrant client will be None. Vector search will not work until Qdrant is available.")
     qclient = None
 
-def retrieve_top_k(query: str, k: int = 6, filter_dict: Optional[Dict] = None) -> List[Dict]:
+PROMPT_MAX_CONTEXT_TOKENS = int(os.getenv("PROMPT_MAX_CONTEXT_TOKENS", "1800"))
+OLLAMA_PREFILL = os.getenv("OLLAMA_PREFILL", "false").lower() == "true"
+_PREFILL_TASKS = set()
+_LAST_LLM_REQUEST = None
+
+# Static instructions sent as the Ollama system message, ahead of every prompt
+_SYSTEM_PROMPT = """You are an expert AI Audit Assistant. Use ONLY the CONTEXT in the user message to answer the QUESTION.
+
+If the answer is not present in the context, reply "I don't know" or "The information is not available in the provided context."
+
+INSTRUCTIONS:
+- Answer concisely and accurately based ONLY on the context provided
+- If you reference numbers, amounts, or dates, ensure they match the context
+- At the end, list the source IDs you used (e.g., "Sources: [Source 1, Source 2]")
+- If the context doesn't contain relevant information, say so clearly"""
+
+NO_RESULTS_ANSWER = "I couldn't find any relevant information in the database to answer your query. Please try rephrasing your question or check if the data has been ingested."
+
+# Amounts/numbers quoted in LLM answers, checked against retrieved sources.
+# google-re2 (optional) scans in linear time with a DFA instead of Python's
+# backtracking engine, which matters for long streamed answers.
+_AMOUNT_PATTERN = r'\$?\s*(\d{1,3}(?:,\d{3})*(?:\.\d+)?)'
+try:
+    import re2
+    _AMOUNT_RE = re2.compile(_AMOUNT_PATTERN)
+except ImportError:
+    _AMOUNT_RE = re.compile(_AMOUNT_PATTERN)
+# Single-pass C-level removal of thousands separators and currency signs
+_AMOUNT_STRIP = str.maketrans("", "", ",$")
+
+# Retrieval cache configuration
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2000"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "300"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+RETRIEVAL_SEMANTIC_CACHE_SIZE = int(os.getenv("RETRIEVAL_SEMANTIC_CACHE_SIZE", "4096"))
+RETRIEVAL_CACHE_LSH_PLANES = int(os.getenv("RETRIEVAL_CACHE_LSH_PLANES", "8"))
+
+class QueryCache:
+    """
+    Thread-safe LRU cache with TTL expiration for retrieval results
+
+    Entries are tagged with the cache version at the time the search started;
+    bumping the version (e.g. after ingestion) drops every cached result.
+    """
+
+    def __init__(self, max_size: int = 2000, ttl_seconds: float = 300.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable) -> Optional[List[Dict]]:
+        """Return cached hits for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            timestamp, hits = entry
+            if time.monotonic() - timestamp >= self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return hits
+
+    def put(self, key: Hashable, hits: List[Dict], version: int) -> None:
+        """Store hits for key unless the cache was invalidated since version"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (time.monotonic(), hits)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> int:
+        """Drop all cached results and bump the version counter"""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            return self.version
+
+class SemanticCache:
+    """
+    Thread-safe FIFO cache of results keyed by query embedding similarity
+
+    Recent normalized query embeddings live in a fixed (N, D) ring buffer, so a
+    lookup is a single matrix-vector product over the whole buffer. With
+    lsh_planes > 0, entries are also bucketed by random-hyperplane LSH
+    signature and only the query's bucket is scanned, which keeps lookups
+    cheap for large caches at the cost of missing some borderline matches.
+    Entries only match lookups with the same scope (e.g. k and filter) and
+    expire ttl_seconds after they were stored (no expiry when None).
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512,
+        threshold: float = 0.95,
+        lsh_planes: int = 0,
+        seed: int = 0,
+        ttl_seconds: Optional[float] = None
+    ):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.lsh_planes = lsh_planes
+        self.seed = seed
+        self._matrix = None
+        self._planes = None
+        self._entries = [None] * max_size
+        self._slot_buckets = [None] * max_size
+        self._buckets = {}
+        self._count = 0
+        self._next = 0
+        self._lock = threading.RLock()
+
+    def _bucket(self, query_vector: np.ndarray) -> bytes:
+        return np.packbits(self._planes @ query_vector > 0).tobytes()
+
+    def get(self, query_vector: np.ndarray, scope: Hashable) -> Optional[Dict]:
+        """Return the cached result for the most similar query above threshold"""
+        with self._lock:
+            if self._count == 0:
+                return None
+            if self._planes is not None:
+                slots = self._buckets.get(self._bucket(query_vector))
+                if not slots:
+                    return None
+                candidates = np.fromiter(slots, dtype=np.intp, count=len(slots))
+                sims = self._matrix[candidates] @ query_vector
+            else:
+                candidates = None
+                sims = self._matrix[:self._count] @ query_vector
+            now = time.monotonic()
+            for idx in np.argsort(-sims):
+                if sims[idx] <= self.threshold:
+                    break
+                slot = candidates[idx] if candidates is not None else idx
+                entry_scope, result, timestamp = self._entries[slot]
+                if self.ttl_seconds is not None and now - timestamp >= self.ttl_seconds:
+                    continue
+                if entry_scope == scope:
+                    return result
+            return None
+
+    def put(self, query_vector: np.ndarray, scope: Hashable, result) -> None:
+        """Cache a result, evicting the oldest entry when full"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if self._matrix is None:
+                dimension = query_vector.shape[0]
+                self._matrix = np.zeros((self.max_size, dimension), dtype=np.float32)
+                if self.lsh_planes > 0:
+                    rng = np.random.default_rng(self.seed)
+                    self._planes = rng.standard_normal((self.lsh_planes, dimension)).astype(np.float32)
+            slot = self._next
+            if self._planes is not None:
+                old_bucket = self._slot_buckets[slot]
+                if old_bucket is not None:
+                    self._buckets[old_bucket].discard(slot)
+                bucket = self._bucket(query_vector)
+                self._buckets.setdefault(bucket, set()).add(slot)
+                self._slot_buckets[slot] = bucket
+            self._matrix[slot] = query_vector
+            self._entries[slot] = (scope, result, time.monotonic())
+            self._next = (slot + 1) % self.max_size
+            self._count = min(self._count + 1, self.max_size)
+
+    def clear(self) -> None:
+        """Drop all cached results"""
+        with self._lock:
+            self._entries = [None] * self.max_size
+            self._slot_buckets = [None] * self.max_size
+            self._buckets = {}
+            self._count = 0
+            self._next = 0
+
+class RetrievalBatcher:
+    """
+    Coalesce concurrent Qdrant queries into a single query_batch_points call
+
+    Requests arriving within max_wait_ms (up to max_batch_size) share one
+    round trip; each caller awaits its own Future for its slice of the
+    batched response.
+    """
+
+    def __init__(self, max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def query(self, request: models.QueryRequest) -> models.QueryResponse:
+        """Queue a query request and wait for its batched response"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._execute(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, batch):
+        try:
+            responses = await qclient.query_batch_points(
+                collection_name=COLLECTION_NAME,
+                requests=[request for request, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+_QUERY_CACHE = QueryCache(max_size=QUERY_CACHE_SIZE, ttl_seconds=QUERY_CACHE_TTL_SECONDS)
+_SEMANTIC_CACHE = SemanticCache(
+    max_size=SEMANTIC_CACHE_SIZE,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl_seconds=QUERY_CACHE_TTL_SECONDS
+)
+_RETRIEVAL_SEMANTIC_CACHE = SemanticCache(
+    max_size=RETRIEVAL_SEMANTIC_CACHE_SIZE,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    lsh_planes=RETRIEVAL_CACHE_LSH_PLANES,
+    ttl_seconds=QUERY_CACHE_TTL_SECONDS
+)
+_RETRIEVAL_BATCHER = RetrievalBatcher(max_batch_size=RETRIEVAL_BATCH_SIZE, max_wait_ms=RETRIEVAL_BATCH_WAIT_MS)
+
+def _filter_cache_key(filter_dict: Optional[Dict]) -> Optional[Hashable]:
+    """Build a hashable key for a metadata filter, or None if it is not hashable"""
+    try:
+        filter_key = frozenset(filter_dict.items()) if filter_dict else frozenset()
+        hash(filter_key)
+        return filter_key
+    except TypeError:
+        return None
+
+# Figures and identifiers in a query ("Q1", "2024", "ACC1000001", "1,250.00")
+_QUERY_FIGURE_RE = re.compile(r'[A-Za-z]*\d[\w.,-]*')
+
+def _query_figures(query: str) -> tuple:
+    """
+    Extract the figures and identifiers of a query for semantic cache scopes
+    
+    Queries differing only in a period, amount or account id embed almost
+    identically; keeping these tokens in the scope lets paraphrases share a
+    cache entry while different figures never do.
+    """
+    return tuple(token.rstrip(".,-").lower() for token in _QUERY_FIGURE_RE.findall(query))
+
+def _query_cache_key(query: str, k: int, filter_dict: Optional[Dict]) -> Optional[Hashable]:
+    """Build the retrieval cache key, or None if the filter is not hashable"""
+    filter_key = _filter_cache_key(filter_dict)
+    if filter_key is None:
+        return None
+    return (query, k, filter_key)
+
+def invalidate_query_cache() -> int:
+    """Invalidate cached retrieval results and answers (call after re-ingesting documents)"""
+    version = _QUERY_CACHE.invalidate()
+    _SEMANTIC_CACHE.clear()
+    _RETRIEVAL_SEMANTIC_CACHE.clear()
+    logger.info(f"Retrieval cache invalidated (version {version})")
+    return version
+
+@functools.lru_cache(maxsize=256)
+def _build_filter(items: tuple) -> models.Filter:
+    """Convert sorted (key, value) pairs to a Qdrant filter, memoized per distinct filter"""
+    return models.Filter(must=[
+        models.FieldCondition(
+            key=key,
+            match=models.MatchValue(value=value)
+        )
+        for key, value in items
+    ])
+
+async def retrieve_top_k(
+    query: str,
+    k: int = 6,
+    filter_dict: Optional[Dict] = None,
+    query_vector: Optional[np.ndarray] = None
+) -> List[Dict]:
     """
     Retrieve top-k most relevant documents from Qdrant
     
@@ -40,178 +377,325 @@ def retrieve_top_k(query: str, k: int = 6, filter_dict: Optional[Dict] = None) -
         query: User query string
         k: Number of documents to retrieve
         filter_dict: Optional metadata filter
+        query_vector: Optional precomputed query embedding
     
     Returns:
         List of retrieved documents with id, score, and payload
     """
+    global qclient
+
+    # Serve repeated queries from cache, skipping both embedding and search
+    cache_key = _query_cache_key(query, k, filter_dict)
+    cache_version = _QUERY_CACHE.version
+    if cache_key is not None:
+        cached = _QUERY_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info(f"Retrieval cache hit for query: {query[:50]}...")
+            return list(cached)
+
+    # Only reachable when QDRANT_REQUIRED is off and the client failed to initialize
     if qclient is None:
         logger.warning("Qdrant client not available, attempting to reconnect...")
         try:
             # Reinitialize global qclient
-            global qclient
-            qclient = QdrantClient(url=QDRANT_URL, timeout=10.0)
+            qclient = _create_qdrant_client()
             # Test connection
-            qclient.get_collections()
+            await qclient.get_collections()
             logger.info("Successfully reconnected to Qdrant")
         except Exception as reconnect_error:
             logger.error(f"Failed to reconnect to Qdrant: {reconnect_error}")
             return []
     
+    # Get embedding model and encode query
+    if query_vector is None:
+        query_vector = await encode_query_async(query)
+    
+    # Near-duplicate queries reuse cached hits, skipping the Qdrant round trip
+    filter_key = _filter_cache_key(filter_dict)
+    semantic_scope = (k, filter_key, _query_figures(query)) if filter_key is not None else None
+    if semantic_scope is not None:
+        cached = _RETRIEVAL_SEMANTIC_CACHE.get(query_vector, semantic_scope)
+        if cached is not None:
+            logger.info(f"Retrieval semantic cache hit for query: {query[:50]}...")
+            return list(cached)
+    
+    # Build query filter if provided
+    query_filter = None
+    if filter_dict:
+        items = tuple(sorted(filter_dict.items()))
+        try:
+            query_filter = _build_filter(items)
+        except TypeError:
+            # Unhashable filter values cannot be memoized
+            query_filter = _build_filter.__wrapped__(items)
+    
+    # Search Qdrant: coarse HNSW prefetch of k * factor candidates over the int8
+    # quantized vectors, re-scored to top-k against the original float32 vectors,
+    # batched with concurrent requests into a single round trip. The vector is converted
+    # to a list once; pydantic would otherwise validate a numpy array element by element,
+    # separately for the outer query and the prefetch.
+    vector = np.asarray(query_vector, dtype=np.float32).tolist()
     try:
-        # Get embedding model and encode query
-        embed_model = get_embed_model()
-        query_vector = embed_model.encode([query], convert_to_numpy=True)[0].tolist()
-        
-        # Build query filter if provided
-        query_filter = None
-        if filter_dict:
-            # Convert filter_dict to Qdrant filter format
-            conditions = []
-            for key, value in filter_dict.items():
-                conditions.append(
-                    models.FieldCondition(
-                        key=key,
-                        match=models.MatchValue(value=value)
-                    )
+        response = await _RETRIEVAL_BATCHER.query(models.QueryRequest(
+            query=vector,
+            prefetch=models.Prefetch(
+                query=vector,
+                filter=query_filter,
+                limit=k * QDRANT_PREFETCH_FACTOR,
+                params=models.SearchParams(
+                    hnsw_ef=QDRANT_HNSW_EF,
+                    exact=False,
+                    quantization=models.QuantizationSearchParams(rescore=False)
                 )
-            if conditions:
-                query_filter = models.Filter(must=conditions)
-        
-        # Search Qdrant
-        hits = qclient.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_vector,
+            ),
+            filter=query_filter,
+            params=models.SearchParams(quantization=models.QuantizationSearchParams(ignore=True)),
             limit=k,
-            query_filter=query_filter
-        )
-        
-        # Format results
-        results = []
-        for hit in hits:
-            payload = hit.payload or {}
-            results.append({
-                "id": hit.id,
-                "score": hit.score,
-                "payload": payload
-            })
-        
-        logger.info(f"Retrieved {len(results)} documents for query: {query[:50]}...")
-        return results
-        
-    except Exception as e:
+            with_payload=True
+        ))
+    except _QDRANT_ERRORS as e:
         logger.error(f"Error retrieving documents: {e}")
         return []
+    
+    # Format results
+    results = []
+    for hit in response.points:
+        payload = hit.payload or {}
+        results.append({
+            "id": hit.id,
+            "score": hit.score,
+            "payload": payload
+        })
+    
+    logger.info(f"Retrieved {len(results)} documents for query: {query[:50]}...")
+    if cache_key is not None:
+        _QUERY_CACHE.put(cache_key, results, cache_version)
+    if semantic_scope is not None and _QUERY_CACHE.version == cache_version:
+        _RETRIEVAL_SEMANTIC_CACHE.put(query_vector, semantic_scope, results)
+    return list(results)
+    
 
-def build_prompt(query: str, hits: List[Dict], max_context_length: int = 2000) -> str:
+async def retrieve_top_k_batch(
+    queries: List[str],
+    k: int = 6,
+    filter_dict: Optional[Dict] = None
+) -> List[List[Dict]]:
     """
-    Build RAG prompt with retrieved context
+    Retrieve top-k documents for several queries at once
     
-    Args:
-        query: User query
-        hits: Retrieved documents
-        max_context_length: Maximum characters for context
+    All queries are embedded with one model call; the concurrent searches are
+    coalesced by the retrieval batcher into query_batch_points round trips
+    (RETRIEVAL_BATCH_SIZE requests each) and still use the retrieval caches.
     
     Returns:
-        Formatted prompt string
+        One result list per query, in input order
+    """
+    if not queries:
+        return []
+    try:
+        vectors = await encode_queries_async(queries)
+    except Exception as e:
+        logger.error(f"Error encoding query batch: {e}")
+        return [[] for _ in queries]
+    return list(await asyncio.gather(*(
+        retrieve_top_k(query, k=k, filter_dict=filter_dict, query_vector=vector)
+        for query, vector in zip(queries, vectors)
+    )))
+
+def _start_prefill() -> Optional[asyncio.Task]:
+    """
+    Start prefilling the static system prompt in Ollama, overlapping with retrieval
+
+    Ollama keeps the prefix cached between requests, so this only fires for the
+    first request and after the model has been idle longer than keep_alive
+    (when it has likely been unloaded).
+    """
+    global _LAST_LLM_REQUEST
+    if not OLLAMA_PREFILL:
+        return None
+    now = time.monotonic()
+    idle = _LAST_LLM_REQUEST is None or now - _LAST_LLM_REQUEST >= OLLAMA_KEEP_ALIVE_SECONDS
+    _LAST_LLM_REQUEST = now
+    if not idle:
+        return None
+    task = asyncio.create_task(prefill_local_llama(_SYSTEM_PROMPT))
+    # Keep a reference so the task survives when the caller returns early (e.g. no hits)
+    _PREFILL_TASKS.add(task)
+    task.add_done_callback(_PREFILL_TASKS.discard)
+    return task
+
+# Payload fields rendered into the prompt context, in priority/display order
+_TEXT_KEYS = ("text", "narration", "description", "content")
+_META_KEYS = (
+    ("amount", "amount"),
+    ("date", "date"),
+    ("account_id", "account"),
+    ("transaction_id", "transaction_id"),
+    ("collection", "source"),
+)
+
+def _render_payload(payload: Dict) -> str:
+    """
+    Format a payload as "metadata\ntext" for the prompt context
+
+    Fallback for documents ingested before the "render" payload field existed;
+    must stay in sync with build_render in scripts/ingest-mongodb-to-qdrant.py.
     """
-    # Build context from retrieved documents
-    context_parts = []
-    current_length = 0
+    # Extract text from various possible fields
+    text = next((value for key in _TEXT_KEYS if (value := payload.get(key))), "")
+    metadata = ", ".join(
+        f"{label}: {value}" for key, label in _META_KEYS if (value := payload.get(key))
+    )
+    return f"{metadata}\n{text}"
+
+def _id_sort_key(hit: Dict) -> tuple:
+    """Order point ids numerically, with string (UUID) ids after integer ids"""
+    point_id = hit["id"]
+    return (isinstance(point_id, str), point_id)
+
+def select_context(hits: List[Dict], max_context_tokens: int = PROMPT_MAX_CONTEXT_TOKENS) -> List[tuple]:
+    """
+    Choose the hits that fit the prompt's token budget
+    
+    Args:
+        hits: Retrieved documents, most relevant first
+        max_context_tokens: Maximum LLM tokens for context
     
+    Returns:
+        (hit, entry) pairs in prompt order; [Source N] in the prompt is the N-th pair
+    """
+    # Token cost of each entry, most relevant first. Documents ingested with a
+    # preformatted render string and token count skip per-query formatting/counting.
+    prefixes = []
+    renders = []
+    entry_tokens = np.empty(len(hits), dtype=np.int64)
     for i, hit in enumerate(hits):
         payload = hit.get("payload", {})
-        
-        # Extract text from various possible fields
-        text = (
-            payload.get("text") or 
-            payload.get("narration") or 
-            payload.get("description") or 
-            payload.get("content") or 
-            ""
-        )
-        
-        # Build context entry with metadata
-        metadata_parts = []
-        if payload.get("amount"):
-            metadata_parts.append(f"amount: {payload['amount']}")
-        if payload.get("date"):
-            metadata_parts.append(f"date: {payload['date']}")
-        if payload.get("account_id"):
-            metadata_parts.append(f"account: {payload['account_id']}")
-        if payload.get("transaction_id"):
-            metadata_parts.append(f"transaction_id: {payload['transaction_id']}")
-        if payload.get("collection"):
-            metadata_parts.append(f"source: {payload['collection']}")
-        
-        metadata_str = ", ".join(metadata_parts)
-        entry = f"[Source {i+1}] id:{hit['id']}"
-        if metadata_str:
-            entry += f" {metadata_str}"
-        entry += f"\n{text}"
-        
-        # Check if adding this entry would exceed max length
-        if current_length + len(entry) > max_context_length and context_parts:
-            break
-            
-        context_parts.append(entry)
-        current_length += len(entry)
+        prefix = f"id:{hit['id']} "
+        render = payload.get("render")
+        render_tokens = payload.get("render_tokens")
+        if render is not None and render_tokens is not None:
+            entry_tokens[i] = count_tokens(prefix) + render_tokens
+        else:
+            if render is None:
+                render = _render_payload(payload)
+            entry_tokens[i] = count_tokens(prefix + render)
+        prefixes.append(prefix)
+        renders.append(render)
     
-    context = "\n\n".join(context_parts)
+    # Keep the longest prefix of hits within the token budget (always at least one),
+    # then only build the entries that made the cut
+    cut = max(int(np.searchsorted(np.cumsum(entry_tokens), max_context_tokens, side="right")), 1)
+    selected = [
+        (hit, prefix + render)
+        for hit, prefix, render in zip(hits[:cut], prefixes, renders)
+    ]
     
-    # Build final prompt
-    prompt = f"""You are an expert AI Audit Assistant. Use ONLY the CONTEXT below to answer the QUESTION.
-
-If the answer is not present in the context, reply "I don't know" or "The information is not available in the provided context."
+    # Order entries by id so identical retrievals always yield byte-identical prompts
+    selected.sort(key=lambda item: _id_sort_key(item[0]))
+    return selected
 
-CONTEXT:
-{context}
+def format_prompt(query: str, context: List[tuple]) -> str:
+    """Format the user prompt from select_context output"""
+    entries = "\n\n".join(f"[Source {i+1}] {entry}" for i, (_, entry) in enumerate(context))
+    
+    # Instructions travel separately as the system message (_SYSTEM_PROMPT)
+    return f"""CONTEXT:
+{entries}
 
 QUESTION:
 {query}
 
-INSTRUCTIONS:
-- Answer concisely and accurately based ONLY on the context provided
-- If you reference numbers, amounts, or dates, ensure they match the context
-- At the end, list the source IDs you used (e.g., "Sources: [Source 1, Source 2]")
-- If the context doesn't contain relevant information, say so clearly
-
 RESPONSE:
 """
+
+def build_prompt(query: str, hits: List[Dict], max_context_tokens: int = PROMPT_MAX_CONTEXT_TOKENS) -> str:
+    """
+    Build RAG prompt with retrieved context
+    
+    Args:
+        query: User query
+        hits: Retrieved documents
+        max_context_tokens: Maximum LLM tokens for context
     
-    return prompt
+    Returns:
+        Formatted prompt string
+    """
+    return format_prompt(query, select_context(hits, max_context_tokens))
+
+def _normalize_amount(amount) -> str:
+    """Normalize an amount for comparison by dropping thousands separators and currency signs"""
+    return str(amount).translate(_AMOUNT_STRIP)
+
+def _parse_amount(amount) -> Optional[float]:
+    """Parse an amount as a float, or None if it is not numeric"""
+    try:
+        return float(_normalize_amount(amount))
+    except ValueError:
+        return None
+
+def _parse_amounts(amounts: List[str]) -> np.ndarray:
+    """Parse amount strings in one vectorized pass (thousands separators and currency signs allowed)"""
+    stripped = np.char.replace(np.char.replace(np.array(amounts, dtype=str), ",", ""), "$", "")
+    return stripped.astype(np.float64)
+
+# Answer and hit amounts closer than this count as the same figure
+_AMOUNT_TOLERANCE = 1e-6
+
+def _mismatch_mask(answer_amounts: np.ndarray, hit_amounts: np.ndarray) -> np.ndarray:
+    """Flag each answer amount that does not appear among the hit amounts"""
+    close = np.abs(answer_amounts[:, None] - hit_amounts[None, :]) < _AMOUNT_TOLERANCE
+    return ~close.any(axis=1)
+
+# Numba (optional) replaces the broadcast comparison matrix with a compiled early-exit loop; compiled once at import
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def _mismatch_mask(answer_amounts, hit_amounts):
+        mask = np.ones(answer_amounts.shape[0], dtype=np.bool_)
+        for i in range(answer_amounts.shape[0]):
+            for j in range(hit_amounts.shape[0]):
+                if abs(answer_amounts[i] - hit_amounts[j]) < _AMOUNT_TOLERANCE:
+                    mask[i] = False
+                    break
+        return mask
+
+    _mismatch_mask(np.zeros(1), np.zeros(1))
+except ImportError:
+    pass
 
-def verify_numeric_claims(answer: str, hits: List[Dict]) -> tuple:
+def collect_hit_amounts(hits: List[Dict]) -> np.ndarray:
+    """Parse the amounts of all retrieved hits once per query"""
+    amounts = [
+        str(amount)
+        for hit in hits
+        if (amount := hit.get("payload", {}).get("amount")) is not None
+    ]
+    try:
+        return _parse_amounts(amounts)
+    except ValueError:
+        # Some amount is not numeric; parse one by one and skip the bad ones
+        parsed = (_parse_amount(amount) for amount in amounts)
+        return np.array([amount for amount in parsed if amount is not None], dtype=np.float64)
+
+def verify_numeric_claims(answer: str, hit_amounts: np.ndarray) -> tuple:
     """
     Verify that numeric claims in the answer exist in retrieved sources
     
     Args:
         answer: LLM-generated answer
-        hits: Retrieved documents
+        hit_amounts: Parsed amounts from retrieved documents (see collect_hit_amounts)
     
     Returns:
         Tuple of (is_valid, warning_message)
     """
-    # Extract amounts/numbers from answer
-    amount_pattern = r'\$?\s*(\d{1,3}(?:,\d{3})*(?:\.\d+)?)'
-    amounts_in_answer = re.findall(amount_pattern, answer)
-    
-    if not amounts_in_answer:
-        return True, ""  # No numeric claims to verify
-    
-    # Extract amounts from hits
-    hit_amounts = []
-    for hit in hits:
-        payload = hit.get("payload", {})
-        amount = payload.get("amount")
-        if amount is not None:
-            hit_amounts.append(str(amount).replace(",", "").replace("$", ""))
-    
     # Check if amounts in answer match hits
-    mismatches = []
-    for ans_amount in amounts_in_answer:
-        ans_clean = ans_amount.replace(",", "").replace("$", "")
-        if ans_clean not in [h.replace(",", "").replace("$", "") for h in hit_amounts]:
-            mismatches.append(ans_amount)
+    answer_amounts = _AMOUNT_RE.findall(answer)
+    if not answer_amounts:
+        return True, ""
+    mask = _mismatch_mask(_parse_amounts(answer_amounts), hit_amounts)
+    mismatches = [amount for amount, mismatch in zip(answer_amounts, mask) if mismatch]
     
     if mismatches:
         warning = f"\n\n[VERIFICATION WARNING] Some numeric claims ({', '.join(mismatches)}) could not be verified from retrieved sources."
@@ -219,7 +703,7 @@ def verify_numeric_claims(answer: str, hits: List[Dict]) -> tuple:
     
     return True, ""
 
-def answer_query(
+async def answer_query(
     query: str, 
     k: int = 6, 
     verify_numbers: bool = True,
@@ -238,28 +722,44 @@ def answer_query(
         Dictionary with answer, sources, hits, and metadata
     """
     try:
-        # Step 1: Retrieve relevant documents
-        hits = retrieve_top_k(query, k=k, filter_dict=filter_dict)
+        # Step 0: Answer paraphrases of recent queries from the semantic cache
+        query_vector = await encode_query_async(query)
+        filter_key = _filter_cache_key(filter_dict)
+        cache_scope = (k, filter_key, verify_numbers, _query_figures(query)) if filter_key is not None else None
+        cached = _SEMANTIC_CACHE.get(query_vector, cache_scope) if cache_scope else None
+        if cached is not None:
+            logger.info(f"Semantic cache hit for query: {query[:50]}...")
+            return {**cached, "query": query}
+        
+        # Step 1: Retrieve relevant documents while Ollama prefills the static prompt prefix
+        prefill_task = _start_prefill()
+        hits = await retrieve_top_k(query, k=k, filter_dict=filter_dict, query_vector=query_vector)
         
         if not hits:
             return {
-                "answer": "I couldn't find any relevant information in the database to answer your query. Please try rephrasing your question or check if the data has been ingested.",
+                "answer": NO_RESULTS_ANSWER,
                 "sources": [],
                 "hits": [],
-                "retrieval_count": 0
+                "retrieval_count": 0,
+                "query": query
             }
         
-        # Step 2: Build prompt with context
-        prompt = build_prompt(query, hits)
+        # Normalize source amounts once; reused by numeric verification
+        hit_amounts = collect_hit_amounts(hits)
         
-        # Step 3: Generate answer using LLM
+        # Step 2: Build prompt with context; sources follow the prompt's [Source N] order
+        context = select_context(hits)
+        prompt = format_prompt(query, context)
+        source_ids = [hit["id"] for hit, _ in context]
+        
+        # Step 3: Generate answer using LLM (after the prefill, so its cached prefix is reused)
+        if prefill_task is not None:
+            await prefill_task
+        # Only real completions are cached; call_local_llama raises on any failure
+        llm_ok = False
         try:
-            answer = call_local_llama(prompt, max_tokens=512, temperature=0.0)
-            
-            # Ensure answer is a valid string
-            if not answer or not isinstance(answer, str) or not answer.strip():
-                logger.warning("LLM returned empty or invalid response, using fallback")
-                answer = "I couldn't generate a response based on the retrieved context. Please try rephrasing your question."
+            answer = await call_local_llama(prompt, max_tokens=512, temperature=0.0, system=_SYSTEM_PROMPT)
+            llm_ok = True
         except Exception as llm_error:
             logger.error(f"LLM generation failed: {llm_error}")
             answer = f"I encountered an error while generating a response: {str(llm_error)}. However, I found {len(hits)} relevant document(s) that might help answer your question."
@@ -267,23 +767,23 @@ def answer_query(
         # Step 4: Verify numeric claims (optional)
         if verify_numbers and answer:
             try:
-                is_valid, warning = verify_numeric_claims(answer, hits)
+                is_valid, warning = verify_numeric_claims(answer, hit_amounts)
                 if not is_valid:
                     answer += warning
             except Exception as verify_error:
                 logger.warning(f"Number verification failed: {verify_error}")
                 # Continue without verification
         
-        # Step 5: Extract source IDs
-        source_ids = [h["id"] for h in hits]
-        
-        return {
+        result = {
             "answer": answer,
             "sources": source_ids,
             "hits": hits,
             "retrieval_count": len(hits),
             "query": query
         }
+        if llm_ok and cache_scope:
+            _SEMANTIC_CACHE.put(query_vector, cache_scope, result)
+        return result
         
     except Exception as e:
         logger.error(f"Error in RAG pipeline: {e}", exc_info=True)
@@ -305,3 +805,86 @@ def answer_query(
             "error": str(e)
         }
 
+
+async def stream_answer_query(
+    query: str,
+    k: int = 6,
+    verify_numbers: bool = True,
+    filter_dict: Optional[Dict] = None
+) -> AsyncIterator[Dict]:
+    """
+    Streaming RAG pipeline: retrieve, build prompt, stream answer tokens
+    
+    Args:
+        query: User query
+        k: Number of documents to retrieve
+        verify_numbers: Whether to verify numeric claims
+        filter_dict: Optional metadata filter for retrieval
+    
+    Yields:
+        Events: "sources" once retrieval finishes, "token" for each generated
+        chunk (plus the verification warning, if any), then "done" or "error"
+    """
+    try:
+        query_vector = await encode_query_async(query)
+        filter_key = _filter_cache_key(filter_dict)
+        cache_scope = (k, filter_key, verify_numbers, _query_figures(query)) if filter_key is not None else None
+        cached = _SEMANTIC_CACHE.get(query_vector, cache_scope) if cache_scope else None
+        if cached is not None:
+            logger.info(f"Semantic cache hit for query: {query[:50]}...")
+            yield {
+                "type": "sources",
+                "sources": cached["sources"],
+                "hits": cached["hits"],
+                "retrieval_count": cached["retrieval_count"]
+            }
+            yield {"type": "token", "content": cached["answer"]}
+            yield {"type": "done"}
+            return
+        
+        prefill_task = _start_prefill()
+        hits = await retrieve_top_k(query, k=k, filter_dict=filter_dict, query_vector=query_vector)
+        if not hits:
+            yield {"type": "sources", "sources": [], "hits": hits, "retrieval_count": 0}
+            yield {"type": "token", "content": NO_RESULTS_ANSWER}
+            yield {"type": "done"}
+            return
+        
+        context = select_context(hits)
+        source_ids = [hit["id"] for hit, _ in context]
+        yield {"type": "sources", "sources": source_ids, "hits": hits, "retrieval_count": len(hits)}
+        
+        hit_amounts = collect_hit_amounts(hits)
+        prompt = format_prompt(query, context)
+        if prefill_task is not None:
+            await prefill_task
+        answer_parts = []
+        async for token in call_local_llama_stream(prompt, max_tokens=512, temperature=0.0, system=_SYSTEM_PROMPT):
+            answer_parts.append(token)
+            yield {"type": "token", "content": token}
+        answer = "".join(answer_parts).strip()
+        
+        # Numeric verification runs on the fully accumulated answer
+        if verify_numbers and answer:
+            try:
+                is_valid, warning = verify_numeric_claims(answer, hit_amounts)
+                if not is_valid:
+                    answer += warning
+                    yield {"type": "token", "content": warning}
+            except Exception as verify_error:
+                logger.warning(f"Number verification failed: {verify_error}")
+        
+        # Reached only when the stream completed; LLM failures raise into the error event
+        if answer and cache_scope:
+            _SEMANTIC_CACHE.put(query_vector, cache_scope, {
+                "answer": answer,
+                "sources": source_ids,
+                "hits": hits,
+                "retrieval_count": len(hits),
+                "query": query
+            })
+        yield {"type": "done"}
+        
+    except Exception as e:
+        logger.error(f"Error in streaming RAG pipeline: {e}", exc_info=True)
+        yield {"type": "error", "error": str(e)}
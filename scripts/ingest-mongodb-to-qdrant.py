@@ -5,14 +5,22 @@ Reads documents from MongoDB collections and indexes them in Qdrant for RAG retr
 """
 import os
 import sys
+import hashlib
+import reprlib
+import sqlite3
+import uuid
 from pymongo import MongoClient
 from qdrant_client import QdrantClient
+import httpx
 from qdrant_client.http import models
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any
+import numpy as np
+from typing import List, Dict, Any, Tuple, Optional
 import logging
 from dotenv import load_dotenv
-import json
+import queue
+import threading
+import urllib.request
 from datetime import datetime
 
 # Load environment variables
@@ -29,9 +37,33 @@ logger = logging.getLogger(__name__)
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
 MONGODB_DB = os.getenv("MONGODB_DB", "audit_data")
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", "32"))
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "audit_documents")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL", "http://localhost:8001")
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "hf-internal-testing/llama-tokenizer")
 BATCH_SIZE = 100
+# SQLite file caching embeddings by content hash across runs (empty disables)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".embed_cache.sqlite3")
+# Batches buffered between the Mongo reader, embedder and upserter stages
+INGEST_QUEUE_DEPTH = 4
+# Threads upserting embedded batches concurrently (gRPC calls release the GIL)
+INGEST_UPSERT_WORKERS = 4
+# Namespace for uuid5 point ids derived from (collection, MongoDB _id)
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "audit-ingest/qdrant-points")
+
+# Fields read by extract_text_from_document and build_payload; everything else stays in MongoDB.
+# The last group feeds the fallback summary of collections without a text field
+# (audit_reports, exception_logs) and must cover their descriptive fields.
+KEEP_FIELDS = {
+    "_id", "narration", "description", "notes", "comment", "remarks", "text", "content",
+    "summary", "details", "name", "title", "message", "amount", "date", "account_id",
+    "transaction_id", "status", "type", "severity", "component",
+    "auditType", "auditor", "department", "findings_count", "critical_findings", "score"
+}
+INGEST_PROJECTION = {field: 1 for field in KEEP_FIELDS}
 
 # Collections to ingest from MongoDB
 COLLECTIONS_TO_INGEST = [
@@ -45,6 +77,15 @@ COLLECTIONS_TO_INGEST = [
     "vendors"
 ]
 
+# Size limits for the summary of documents without any known text field
+FALLBACK_SUMMARY_CHARS = 500
+FALLBACK_FIELD_CHARS = 200
+# Bounded repr for nested values: stops descending instead of stringifying the whole tree
+_FALLBACK_REPR = reprlib.Repr()
+_FALLBACK_REPR.maxlevel = 3
+_FALLBACK_REPR.maxdict = _FALLBACK_REPR.maxlist = 10
+_FALLBACK_REPR.maxstring = _FALLBACK_REPR.maxother = FALLBACK_FIELD_CHARS
+
 def extract_text_from_document(doc: Dict, collection_name: str) -> str:
     """
     Extract searchable text from a MongoDB document
@@ -61,7 +102,7 @@ def extract_text_from_document(doc: Dict, collection_name: str) -> str:
     # Common fields that contain text
     text_fields = [
         "narration", "description", "notes", "comment", "remarks",
-        "text", "content", "summary", "details", "name", "title"
+        "text", "content", "summary", "details", "name", "title", "message"
     ]
     
     for field in text_fields:
@@ -77,13 +118,58 @@ def extract_text_from_document(doc: Dict, collection_name: str) -> str:
         text_parts.append(f"account {doc['account_id']}")
     if "transaction_id" in doc:
         text_parts.append(f"transaction {doc['transaction_id']}")
+    if "severity" in doc:
+        text_parts.append(f"severity {doc['severity']}")
+    if "component" in doc:
+        text_parts.append(f"component {doc['component']}")
     
-    # If no text found, create a summary from all fields
+    # If no text found, create a bounded summary from the top-level fields
     if not text_parts:
-        text_parts.append(json.dumps(doc, default=str)[:500])
+        summary = []
+        length = 0
+        for key, value in doc.items():
+            if isinstance(value, (dict, list, tuple)):
+                value = _FALLBACK_REPR.repr(value)
+            part = f"{key}:{value}"[:FALLBACK_FIELD_CHARS]
+            summary.append(part)
+            length += len(part) + 1
+            if length >= FALLBACK_SUMMARY_CHARS:
+                break
+        text_parts.append(" ".join(summary)[:FALLBACK_SUMMARY_CHARS])
     
     return " ".join(text_parts)
 
+# Payload fields rendered into the prompt context, in priority/display order
+_TEXT_KEYS = ("text", "narration", "description", "content")
+_META_KEYS = (
+    ("amount", "amount"),
+    ("date", "date"),
+    ("account_id", "account"),
+    ("transaction_id", "transaction_id"),
+    ("collection", "source"),
+)
+
+def build_render(payload: Dict) -> str:
+    """
+    Preformat a payload as "metadata\ntext" for the RAG prompt context
+    
+    Must stay in sync with _render_payload in rag-service/app/rag_pipeline.py
+    """
+    text = next((value for key in _TEXT_KEYS if (value := payload.get(key))), "")
+    metadata = ", ".join(
+        f"{label}: {value}" for key, label in _META_KEYS if (value := payload.get(key))
+    )
+    return f"{metadata}\n{text}"
+
+def load_prompt_tokenizer():
+    """Load the tokenizer the RAG service budgets prompts with (None if unavailable)"""
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(PROMPT_TOKENIZER, use_fast=True)
+    except Exception as e:
+        logger.warning(f"Prompt tokenizer unavailable ({e}); render_tokens will not be stored")
+        return None
+
 def create_collection_if_not_exists(qclient: QdrantClient, collection_name: str, vector_size: int):
     """Create Qdrant collection if it doesn't exist"""
     try:
@@ -92,11 +178,30 @@ def create_collection_if_not_exists(qclient: QdrantClient, collection_name: str,
         
         if collection_name not in collection_names:
             logger.info(f"Creating Qdrant collection: {collection_name} with vector size {vector_size}")
+            # Searches run on int8 quantized vectors kept in RAM; the float32 originals
+            # stay on disk and are only read to re-score the final candidates.
+            # Embeddings are L2-normalized on both the ingest and query side, so plain
+            # DOT equals cosine similarity without Qdrant re-normalizing vectors.
             qclient.create_collection(
                 collection_name=collection_name,
                 vectors_config=models.VectorParams(
                     size=vector_size,
-                    distance=models.Distance.COSINE
+                    distance=models.Distance.DOT,
+                    on_disk=True
+                ),
+                # Slightly denser graph build than the default (ef_construct=100) so
+                # queries can use a smaller hnsw_ef; small segments are brute-forced
+                hnsw_config=models.HnswConfigDiff(
+                    m=16,
+                    ef_construct=128,
+                    full_scan_threshold=10000
+                ),
+                quantization_config=models.ScalarQuantization(
+                    scalar=models.ScalarQuantizationConfig(
+                        type=models.ScalarType.INT8,
+                        quantile=0.99,
+                        always_ram=True
+                    )
                 )
             )
             logger.info(f"Collection {collection_name} created successfully")
@@ -106,20 +211,197 @@ def create_collection_if_not_exists(qclient: QdrantClient, collection_name: str,
         logger.error(f"Error creating collection: {e}")
         raise
 
+def build_payload(doc: Dict, collection_name: str, tokenizer=None) -> Tuple[Dict, str]:
+    """
+    Build the Qdrant payload and embedding text for a MongoDB document
+    
+    Returns:
+        Tuple of (payload, text)
+    """
+    # Extract text
+    text = extract_text_from_document(doc, collection_name)
+    
+    # Create payload
+    payload = {
+        "collection": collection_name,
+        "text": text,
+        "original_id": str(doc.get("_id", "")),
+        "ingested_at": datetime.utcnow().isoformat()
+    }
+    
+    # Copy relevant fields to payload
+    for field in ["amount", "date", "account_id", "transaction_id", "narration", 
+                 "description", "status", "type", "name", "title"]:
+        if field in doc:
+            payload[field] = doc[field]
+    
+    # Preformat the prompt context entry so the RAG service does no per-query formatting
+    payload["render"] = build_render(payload)
+    if tokenizer is not None:
+        payload["render_tokens"] = len(tokenizer.encode(payload["render"], add_special_tokens=False))
+    
+    return payload, text
+
+class EmbeddingCache:
+    """
+    On-disk embeddings keyed by sha256 of the model name and text
+    
+    Lets re-ingestion skip encoding documents whose text has not changed.
+    Vectors are stored as raw float32 bytes.
+    """
+    
+    def __init__(self, path: str, model_name: str):
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+    
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).digest()
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return cached vectors for the keys that are present"""
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE hash IN ({placeholders})", keys
+            ).fetchall()
+        return {key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows}
+    
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        """Store vectors in a single transaction"""
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(keys, vectors)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)", rows)
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_embedding_cache(model_name: str):
+    """Open the on-disk embedding cache (None if disabled or unavailable)"""
+    if not EMBED_CACHE_PATH:
+        return None
+    try:
+        cache = EmbeddingCache(EMBED_CACHE_PATH, model_name)
+        logger.info(f"Using embedding cache: {EMBED_CACHE_PATH}")
+        return cache
+    except Exception as e:
+        logger.warning(f"Embedding cache unavailable ({e}); all documents will be encoded")
+        return None
+
+def embed_batch(embed_model: SentenceTransformer, texts: List[str], embed_cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+    """Embed a batch of texts with a single encode call, encoding only cache misses"""
+    if embed_cache is None:
+        return embed_model.encode(
+            texts,
+            batch_size=BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+            normalize_embeddings=True
+        )
+    
+    keys = [embed_cache.key(text) for text in texts]
+    cached = embed_cache.get_many(keys)
+    misses = [i for i, key in enumerate(keys) if key not in cached]
+    encoded = None
+    if misses:
+        encoded = np.asarray(embed_model.encode(
+            [texts[i] for i in misses],
+            batch_size=BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+            normalize_embeddings=True
+        ), dtype=np.float32)
+        embed_cache.put_many([keys[i] for i in misses], encoded)
+    if not cached:
+        return encoded
+    
+    dimension = next(iter(cached.values())).shape[0]
+    vectors = np.empty((len(texts), dimension), dtype=np.float32)
+    for i, key in enumerate(keys):
+        if key in cached:
+            vectors[i] = cached[key]
+    if misses:
+        vectors[misses] = encoded
+    return vectors
+
+def point_id_for(collection_name: str, doc_id: Any) -> str:
+    """
+    Deterministic Qdrant point id for a MongoDB document
+    
+    Re-ingesting a document overwrites its existing point instead of adding a
+    duplicate, so repeated runs are idempotent.
+    """
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{collection_name}:{doc_id}"))
+
+def upsert_points(qclient: QdrantClient, ids: List[str], vectors: Any, payloads: List[Dict]) -> int:
+    """
+    Upsert a batch of embedded documents as Qdrant points
+    
+    The batch stays in parallel ids/vectors/payloads columns sent as one
+    models.Batch: the (N, D) array is converted with a single tolist() per batch,
+    without building a PointStruct model per row. Going through qclient.upsert
+    reuses the shared connection (and its timeout/keep-alive settings) instead
+    of the fresh channel upload_collection opens on every call.
+    """
+    qclient.upsert(
+        collection_name=COLLECTION_NAME,
+        points=models.Batch(
+            ids=ids,
+            vectors=np.asarray(vectors).tolist(),
+            payloads=payloads
+        ),
+        wait=True
+    )
+    return len(ids)
+
+def _run_stage(work, inbox: queue.Queue, outbox, errors: List[Exception]):
+    """
+    Apply work to each batch from inbox until the None sentinel, forwarding results to outbox
+    
+    After any stage fails, remaining batches are drained without work so upstream
+    stages never block on a full queue. Sentinels for the next stage are sent by
+    the caller once every worker of this stage has finished.
+    """
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        if errors:
+            continue
+        try:
+            result = work(batch)
+            if outbox is not None:
+                outbox.put(result)
+        except Exception as e:
+            errors.append(e)
+
 def ingest_collection(
     mongo_client: MongoClient,
     qclient: QdrantClient,
     embed_model: SentenceTransformer,
     collection_name: str,
-    db_name: str
+    db_name: str,
+    tokenizer=None,
+    embed_cache: Optional[EmbeddingCache] = None
 ):
-    """Ingest a single MongoDB collection into Qdrant"""
+    """
+    Ingest a single MongoDB collection into Qdrant
+    
+    Runs as a three-stage pipeline so Mongo reads, embedding and upserts overlap:
+    this thread reads and builds payloads, an embedder thread encodes each batch
+    and INGEST_UPSERT_WORKERS upserter threads write the points.
+    """
     try:
         db = mongo_client[db_name]
         collection = db[collection_name]
         
-        # Count documents
-        total_docs = collection.count_documents({})
+        # Count documents (metadata-based estimate, avoids a full collection scan)
+        total_docs = collection.estimated_document_count()
         if total_docs == 0:
             logger.warning(f"Collection {collection_name} is empty, skipping")
             return 0
@@ -127,74 +409,68 @@ def ingest_collection(
         logger.info(f"Ingesting {total_docs} documents from {collection_name}...")
         
         # Process in batches
-        batch = []
+        ids, payloads, texts = [], [], []
         ingested_count = 0
-        point_id = 0
         
-        # Get existing max ID from Qdrant to avoid conflicts
-        try:
-            existing_points = qclient.scroll(
-                collection_name=COLLECTION_NAME,
-                limit=1,
-                with_payload=True
-            )[0]
-            if existing_points:
-                point_id = max([p.id for p in existing_points]) + 1
-        except:
-            point_id = 0
+        def embed(batch):
+            batch_ids, batch_payloads, batch_texts = batch
+            return batch_ids, embed_batch(embed_model, batch_texts, embed_cache), batch_payloads
         
-        for doc in collection.find({}):
-            try:
-                # Extract text
-                text = extract_text_from_document(doc, collection_name)
-                
-                # Create payload
-                payload = {
-                    "collection": collection_name,
-                    "text": text,
-                    "original_id": str(doc.get("_id", "")),
-                    "ingested_at": datetime.utcnow().isoformat()
-                }
-                
-                # Copy relevant fields to payload
-                for field in ["amount", "date", "account_id", "transaction_id", "narration", 
-                             "description", "status", "type", "name", "title"]:
-                    if field in doc:
-                        payload[field] = doc[field]
-                
-                # Generate embedding
-                embedding = embed_model.encode([text], convert_to_numpy=True)[0].tolist()
-                
-                # Add to batch
-                batch.append(models.PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload=payload
-                ))
+        count_lock = threading.Lock()
+        
+        def upsert(batch):
+            nonlocal ingested_count
+            upserted = upsert_points(qclient, *batch)
+            with count_lock:
+                ingested_count += upserted
+                logger.info(f"  Ingested {ingested_count}/{total_docs} documents...")
+        
+        embed_queue = queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+        upsert_queue = queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+        errors = []
+        embedder = threading.Thread(target=_run_stage, args=(embed, embed_queue, upsert_queue, errors), daemon=True)
+        upserters = [
+            threading.Thread(target=_run_stage, args=(upsert, upsert_queue, None, errors), daemon=True)
+            for _ in range(INGEST_UPSERT_WORKERS)
+        ]
+        embedder.start()
+        for upserter in upserters:
+            upserter.start()
+        
+        try:
+            # Only transfer and decode the fields we read, in cursor batches matching the embed batch
+            cursor = collection.find({}, projection=INGEST_PROJECTION).batch_size(BATCH_SIZE)
+            for doc in cursor:
+                if errors:
+                    break
+                try:
+                    payload, text = build_payload(doc, collection_name, tokenizer)
+                except Exception as e:
+                    logger.error(f"Error processing document {doc.get('_id')}: {e}")
+                    continue
                 
-                point_id += 1
+                ids.append(point_id_for(collection_name, doc["_id"]))
+                payloads.append(payload)
+                texts.append(text)
                 
-                # Upsert batch when full
-                if len(batch) >= BATCH_SIZE:
-                    qclient.upsert(
-                        collection_name=COLLECTION_NAME,
-                        points=batch
-                    )
-                    ingested_count += len(batch)
-                    logger.info(f"  Ingested {ingested_count}/{total_docs} documents...")
-                    batch = []
-                    
-            except Exception as e:
-                logger.error(f"Error processing document {doc.get('_id')}: {e}")
-                continue
+                # Hand the batch to the embedder when full
+                if len(texts) >= BATCH_SIZE:
+                    embed_queue.put((ids, payloads, texts))
+                    ids, payloads, texts = [], [], []
+            
+            # Hand off remaining batch
+            if texts and not errors:
+                embed_queue.put((ids, payloads, texts))
+        finally:
+            embed_queue.put(None)
+            embedder.join()
+            for _ in upserters:
+                upsert_queue.put(None)
+            for upserter in upserters:
+                upserter.join()
         
-        # Upsert remaining batch
-        if batch:
-            qclient.upsert(
-                collection_name=COLLECTION_NAME,
-                points=batch
-            )
-            ingested_count += len(batch)
+        if errors:
+            raise errors[0]
         
         logger.info(f"✓ Ingested {ingested_count} documents from {collection_name}")
         return ingested_count
@@ -203,6 +479,15 @@ def ingest_collection(
         logger.error(f"Error ingesting collection {collection_name}: {e}")
         return 0
 
+def notify_rag_service():
+    """Ask the running RAG service to drop its cached retrieval results"""
+    try:
+        request = urllib.request.Request(f"{RAG_SERVICE_URL}/api/cache/invalidate", method="POST")
+        with urllib.request.urlopen(request, timeout=5) as response:
+            logger.info(f"RAG service retrieval cache invalidated: {response.read().decode()}")
+    except Exception as e:
+        logger.warning(f"Could not invalidate RAG service cache ({e}). Cached results expire within QUERY_CACHE_TTL_SECONDS (default 300s).")
+
 def main():
     """Main ingestion function"""
     logger.info("Starting MongoDB to Qdrant ingestion...")
@@ -218,7 +503,14 @@ def main():
     
     # Connect to Qdrant
     try:
-        qclient = QdrantClient(url=QDRANT_URL)
+        # gRPC sends vectors as protobuf floats instead of JSON; REST falls back to a keep-alive pool
+        qclient = QdrantClient(
+            url=QDRANT_URL,
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            grpc_port=QDRANT_GRPC_PORT,
+            limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_POOL_SIZE),
+            timeout=30
+        )
         logger.info(f"Connected to Qdrant: {QDRANT_URL}")
     except Exception as e:
         logger.error(f"Failed to connect to Qdrant: {e}")
@@ -234,6 +526,9 @@ def main():
         logger.error(f"Failed to load embedding model: {e}")
         sys.exit(1)
     
+    tokenizer = load_prompt_tokenizer()
+    embed_cache = open_embedding_cache(EMBED_MODEL_NAME)
+    
     # Create collection if needed
     try:
         create_collection_if_not_exists(qclient, COLLECTION_NAME, vector_size)
@@ -250,7 +545,9 @@ def main():
                 qclient,
                 embed_model,
                 collection_name,
-                MONGODB_DB
+                MONGODB_DB,
+                tokenizer,
+                embed_cache
             )
             total_ingested += count
         except Exception as e:
@@ -261,8 +558,13 @@ def main():
     logger.info(f"Ingestion complete! Total documents ingested: {total_ingested}")
     logger.info(f"{'='*60}")
     
+    if total_ingested:
+        notify_rag_service()
+    
     # Close connections
     mongo_client.close()
+    if embed_cache is not None:
+        embed_cache.close()
 
 if __name__ == "__main__":
     main()
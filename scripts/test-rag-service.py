@@ -3,6 +3,7 @@
 Test script for RAG service
 Validates embedding model, Qdrant connection, and end-to-end RAG pipeline
 """
+import asyncio
 import sys
 import os
 
@@ -40,12 +41,12 @@ def test_qdrant_connection():
         print(f"❌ Qdrant connection failed: {e}")
         return False
 
-def test_ollama_connection():
+async def test_ollama_connection():
     """Test Ollama connection"""
     print("\n🔍 Testing Ollama connection...")
     try:
         from app.model_clients import verify_ollama_available
-        if verify_ollama_available():
+        if await verify_ollama_available():
             print("✅ Ollama is available")
             return True
         else:
@@ -55,12 +56,12 @@ def test_ollama_connection():
         print(f"❌ Ollama test failed: {e}")
         return False
 
-def test_retrieval():
+async def test_retrieval():
     """Test document retrieval"""
     print("\n🔍 Testing document retrieval...")
     try:
         from app.rag_pipeline import retrieve_top_k
-        results = retrieve_top_k("test query", k=3)
+        results = await retrieve_top_k("test query", k=3)
         print(f"✅ Retrieval test: {len(results)} documents retrieved")
         if results:
             print(f"   Sample result: ID={results[0].get('id')}, Score={results[0].get('score', 0):.4f}")
@@ -69,12 +70,12 @@ def test_retrieval():
         print(f"❌ Retrieval test failed: {e}")
         return False
 
-def test_end_to_end():
+async def test_end_to_end():
     """Test end-to-end RAG pipeline"""
     print("\n🔍 Testing end-to-end RAG pipeline...")
     try:
         from app.rag_pipeline import answer_query
-        result = answer_query("What transactions exist?", k=3, verify_numbers=False)
+        result = await answer_query("What transactions exist?", k=3, verify_numbers=False)
         print(f"✅ End-to-end test completed")
         print(f"   Answer length: {len(result.get('answer', ''))} chars")
         print(f"   Sources: {len(result.get('sources', []))}")
@@ -84,6 +85,14 @@ def test_end_to_end():
         print(f"❌ End-to-end test failed: {e}")
         return False
 
+async def run_async_tests():
+    """Run the async tests on a single event loop (shared HTTP clients are loop-bound)"""
+    return [
+        ("Ollama Connection", await test_ollama_connection()),
+        ("Document Retrieval", await test_retrieval()),
+        ("End-to-End Pipeline", await test_end_to_end()),
+    ]
+
 def main():
     """Run all tests"""
     print("=" * 60)
@@ -93,9 +102,7 @@ def main():
     results = []
     results.append(("Embedding Model", test_embedding_model()))
     results.append(("Qdrant Connection", test_qdrant_connection()))
-    results.append(("Ollama Connection", test_ollama_connection()))
-    results.append(("Document Retrieval", test_retrieval()))
-    results.append(("End-to-End Pipeline", test_end_to_end()))
+    results.extend(asyncio.run(run_async_tests()))
     
     print("\n" + "=" * 60)
     print("Test Results Summary")